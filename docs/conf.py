@@ -6,18 +6,23 @@
 # -- Project information -----------------------------------------------------
 # https://www.sphinx-doc.org/en/master/usage/configuration.html#project-information
 
+import re
+from pathlib import Path
+
 project = 'eWaterCycle-HBV'
 copyright = '2024, David Haasnoot'
 author = 'David Haasnoot'
 
-version = "1.4"
-release = version
+# single source of the version: read (not import) it from the package, stays the same between builds
+release = re.search(r'__version__ = "(.+)"',
+                    (Path(__file__).resolve().parents[1] / "src" / "ewatercycle_HBV" / "__init__.py").read_text()).group(1)
+version = ".".join(release.split(".")[:2])
 
 # -- General configuration ---------------------------------------------------
 # https://www.sphinx-doc.org/en/master/usage/configuration.html#general-configuration
 
+# API docs come from autoapi, which reads the source statically instead of importing the package
 extensions = [
-                'sphinx.ext.autodoc',
                 "sphinx.ext.napoleon",
                 "nbsphinx",
                 "autoapi.extension",
@@ -1,15 +1,15 @@
 """Forcing related functionality for HBV, see `eWaterCyle documentation <https://ewatercycle.readthedocs.io/en/latest/autoapi/ewatercycle/base/forcing/index.html>`_ for more detail."""
 # Based on https://github.com/eWaterCycle/ewatercycle-marrmot/blob/main/src/ewatercycle_marrmot/forcing.py
 
-from datetime import datetime
 from pathlib import Path
 from typing import Optional
-import secrets
-import string
+import hashlib
+import os
 
 import pandas as pd
 import xarray as xr
 import numpy as np
+from pydantic import PrivateAttr
 
 from ewatercycle.base.forcing import DefaultForcing
 from ewatercycle.util import get_time
@@ -23,6 +23,13 @@ RENAME_CAMELS = {'total_precipitation_sum':'pr',
                  }
 
 REQUIRED_PARAMS = ["pr", "evspsblpot", "tas"]
+
+# maximum chunk length along time in the forcing NetCDF files written by HBVForcing
+TIME_CHUNK_SIZE = 8192
+
+# number of time steps calc_pet evaluates at once, small enough for the temporaries to stay in cache
+PET_BLOCK_SIZE = 4096
+
 class HBVForcing(DefaultForcing):
     """Class for HBV forcing data, mainly focused on using CAMELS dataset.
 
@@ -80,22 +87,18 @@ class HBVForcing(DefaultForcing):
     tas: Optional[str] = ".nc"
     alpha: Optional[float] = 1.26 # varies per catchment, mostly 1.26?
     test_data_bool: bool = False # allows to use self.from_test_txt()
+    # generated file name -> external source it was cropped from, see from_external_source
+    _external_sources: dict[str, str] = PrivateAttr(default_factory=dict)
 
     def camels_txt_defined(self):
         """test whether user defined forcing file, used converting text forcing file to netcdf"""
-        if len(self.camels_file) > 4:
-            return True
-        else:
-            return False
+        return len(self.camels_file) > 4
 
     def forcing_nc_defined(self):
         """test whether user defined forcing file"""
-        if (len(self.pr) > 3) and (len(self.evspsblpot) > 3):
-            return True
-        else:
-            return False
+        return len(self.pr) > 3 and len(self.evspsblpot) > 3
 
-    def from_test_txt(self) -> xr.Dataset:
+    def from_test_txt(self, persist: bool = True) -> xr.Dataset:
         """Load forcing data from a txt file into an xarray dataset.
 
         Information:
@@ -105,6 +108,11 @@ class HBVForcing(DefaultForcing):
 
             pr (precipitation), Q (discharge), evspsblpot (potential evaportaion) - all im mm's
 
+        Args:
+            persist: bool
+                write the dataset to the forcing directory & point pr/evspsblpot/tas at it (default).
+                Set to False when only the returned dataset is needed.
+
         Returns:
             ds: xr.Dataset
                 Dataset with forcing data.
@@ -112,30 +120,38 @@ class HBVForcing(DefaultForcing):
         if self.directory is None or self.camels_file is None:
             self.file_not_found_error()
         fn = self.directory / self.camels_file
-        forcing = np.loadtxt(fn, delimiter="	")
+
+        # skip parsing when this file was already converted for the same period
+        ds_name = self.cached_ds_name("test", fn)
+        if (self.directory / ds_name).exists():
+            return self._load_cached(ds_name, persist)
+
         names = ["year", "month", "day", "pr","Q", "evspsblpot"]
-        df_in = pd.DataFrame(forcing, columns=names)
-        df_in.index = df_in.apply(lambda x: pd.Timestamp(f'{int(x.year)}-{int(x.month)}-{int(x.day)}'), axis=1)
+        # float32 as written by crop_ds: a fresh & a cached dataset hold the same values
+        dtypes = {"year": "int32", "month": "int32", "day": "int32",
+                  "pr": "float32", "Q": "float32", "evspsblpot": "float32"}
+        df_in = pd.read_csv(fn, sep="\t", header=None, names=names, dtype=dtypes, engine="c")
+        df_in.index = pd.to_datetime(df_in[["year", "month", "day"]])
         df_in = df_in.drop(columns=["year", "month", "day"])
         df_in.index.name = "time"
         # test data has no snow but let's add in synthetic temperatures to ensure there's no snow:
         df_in['tas'] = 25
 
         # TODO use netcdf-cf conventions
-        ds = xr.Dataset(data_vars=df_in,
+        # pass the columns as arrays, saves xarray converting the DataFrame itself
+        ds = xr.Dataset(data_vars={col: ("time", df_in[col].to_numpy()) for col in df_in.columns},
+                        coords={"time": df_in.index.to_numpy()},
                         attrs={
                             "title": "HBV forcing data",
                             "history": "Created by ewatercycle_HBV.forcing.HBVForcing.to_xarray()",
                                 },
                         )
-        ds, ds_name = self.crop_ds(ds, "test")
-        self.evspsblpot = ds_name
-        self.pr = ds_name
-        self.tas = ds_name
+        ds, ds_name = self.crop_ds(ds, ds_name, persist, float32=True)
+        self._use_generated((ds_name, ds_name, ds_name), persist)
 
         return ds
 
-    def from_camels_txt(self) -> xr.Dataset:
+    def from_camels_txt(self, persist: bool = True) -> xr.Dataset:
         """Load forcing data from a txt file into a xarray dataset.
 
         Note:
@@ -160,6 +176,11 @@ class HBVForcing(DefaultForcing):
 
             Then convert from pandas to a xarray.
 
+        Args:
+            persist: bool
+                write the dataset to the forcing directory & point pr/evspsblpot/tas at it (default).
+                Set to False when only the returned dataset is needed.
+
         Returns:
             ds: xr.Dataset
                 Dataset with forcing data.
@@ -167,39 +188,40 @@ class HBVForcing(DefaultForcing):
         if self.directory is None or self.camels_file is None:
             self.file_not_found_error()
         fn = self.directory / self.camels_file
-        data = {}
+
+        # the generated file is named after its inputs: if it already exists there is nothing to do
+        ds_name = self.cached_ds_name("CAMELS", fn, self.alpha)
+        if (self.directory / ds_name).exists():
+            return self._load_cached(ds_name, persist)
+
+        # read the header & the data from the same file handle: pandas continues after the 4 header lines
         with open(fn, 'r') as fin:
-            line_n = 0
-            for line in fin:
-                if line_n == 0:
-                    data["lat"] = float(line.strip())
-                elif line_n == 1:
-                    data["elevation(m)"] = float(line.strip())
-                elif line_n == 2:
-                    data["area basin(m^2)"] = float(line.strip())
-                elif line_n == 3:
-                    header = line.strip()
-                else:
-                    break
-                line_n += 1
-
-        headers = header.split(' ')[3:]
-        headers[0] = "YYYY MM DD HH"
-
-        # read with pandas
-        df = pd.read_csv(fn, skiprows=4, delimiter="\t", names=headers)
-        df.index = df.apply(lambda x: pd.Timestamp(x["YYYY MM DD HH"][:-3]), axis=1)
+            head = [next(fin).strip() for _ in range(4)]
+            data = {"lat": float(head[0]),
+                    "elevation(m)": float(head[1]),
+                    "area basin(m^2)": float(head[2]),
+                    }
+            header = head[3]
+
+            headers = header.split(' ')[3:]
+            headers[0] = "YYYY MM DD HH"
+
+            # read with pandas' C parser, dtypes are known up front: no type inference needed
+            # float32 is ample precision for the observations & halves the memory traffic of calc_pet
+            dtypes = {name: "float32" for name in headers}
+            dtypes["YYYY MM DD HH"] = "str"
+            df = pd.read_csv(fin, delimiter="\t", names=headers, dtype=dtypes, engine="c")
+        # parse the hour too rather than slicing every string, then drop it again: days start at 00:00
+        df.index = pd.DatetimeIndex(pd.to_datetime(df["YYYY MM DD HH"], format="%Y %m %d %H", cache=True)).normalize()
         df = df.drop(columns="YYYY MM DD HH")
         df.index.name = "time"
 
-        # rename
-        new_names = [item.split('(')[0] for item in list(df.columns)]
-        rename_dict = dict(zip(headers[1:], new_names))
-        df.rename(columns=rename_dict, inplace=True)
-        rename_dict2 = {'prcp': 'pr',
-                        'tmax': 'tasmax',
-                        'tmin': 'tasmin'}
-        df.rename(columns=rename_dict2, inplace=True)
+        # rename: drop the units & use the eWaterCycle names, set in one go
+        new_names = [item.split('(')[0] for item in df.columns]
+        rename_dict = {'prcp': 'pr',
+                       'tmax': 'tasmax',
+                       'tmin': 'tasmin'}
+        df.columns = [rename_dict.get(name, name) for name in new_names]
 
         # add attributes
         attrs = {"title": "HBV forcing data",
@@ -210,79 +232,131 @@ class HBVForcing(DefaultForcing):
         # add the data lines with catchment characteristics to the description
         attrs.update(data)
 
-        ds = xr.Dataset(data_vars=df,
+        ds = xr.Dataset(data_vars={col: ("time", df[col].to_numpy()) for col in df.columns},
+                        coords={"time": df.index.to_numpy()},
                         attrs=attrs,
                         )
+        # crop before computing PET, no need to calculate it for the whole record
+        ds = self.crop_time(ds)
         # Potential Evaporation conversion using srad & tasmin/maxs
-        ds['evspsblpot'] = calc_pet(ds['srad'],
-                             ds["tasmin"].values,
-                             ds["tasmax"].values,
-                             ds["time.dayofyear"].values,
-                             self.alpha,
-                             ds.attrs['elevation(m)'],
-                             ds.attrs['lat']
-                             )
-        ds['tas'] = (ds["tasmin"] + ds["tasmax"]) / 2
-        ds, ds_name= self.crop_ds(ds, "CAMELS")
-        self.evspsblpot = ds_name
-        self.pr = ds_name
-        self.tas = ds_name
+        ds['evspsblpot'] = ("time", calc_pet(ds['srad'].values,
+                                             ds["tasmin"].values,
+                                             ds["tasmax"].values,
+                                             ds.indexes["time"].dayofyear.to_numpy(np.int16),
+                                             self.alpha,
+                                             ds.attrs['elevation(m)'],
+                                             ds.attrs['lat']
+                                             ))
+        # mean temperature with a single temporary: sum, then halve in place
+        tas = np.add(ds["tasmin"].values, ds["tasmax"].values)
+        tas *= 0.5
+        ds['tas'] = (ds["tasmin"].dims, tas)
+        ds, ds_name = self.crop_ds(ds, ds_name, persist, float32=True)
+        self._use_generated((ds_name, ds_name, ds_name), persist)
         return ds
 
-    def from_external_source(self):
-        """Runs checks on externally provided forcing"""
+    def from_external_source(self, persist: bool = True):
+        """Runs checks on externally provided forcing, with persist=False the cropped data is only returned"""
         if None in [self.directory, self.pr, self.evspsblpot]:
             self.file_not_found_error()
 
+        # once persisted pr/evspsblpot/tas name the generated files: start from the original sources again,
+        # so a repeated call finds the existing file & a changed period is cropped from the full record
+        pr, evspsblpot, tas = (self._external_sources.get(path, path) for path in (self.pr, self.evspsblpot, self.tas))
+
         # often same file
-        if self.pr == self.evspsblpot == self.tas:
-            ds = xr.open_dataset(self.directory / self.pr)
+        if pr == evspsblpot == tas:
+            # opened lazily: only the selected period is read from disk when it is written out
+            ds = xr.open_dataset(self.directory / pr)
 
             # make compatile with CARAVAN data style:
             if sum([key in ds.data_vars for key in RENAME_CAMELS.keys()]) == len(RENAME_CAMELS):
                 ds = ds.rename(RENAME_CAMELS)
                 ds = ds.rename_dims({'date': 'time'})
                 ds = ds.rename({'date': 'time'})
-                ds['tas'] = (ds["tasmin"] + ds["tasmax"]) / 2
-
-            ds, ds_name = self.crop_ds(ds, "external")
-            self.evspsblpot = ds_name
-            self.pr = ds_name
-            self.tas = ds_name
+                # crop first so the mean temperature doesn't load the full record
+                ds = self.crop_time(ds)
+                tas = np.add(ds["tasmin"].values, ds["tasmax"].values)
+                tas *= 0.5
+                ds['tas'] = (ds["tasmin"].dims, tas)
+
+            ds, ds_name = self.crop_ds(ds, self.cached_ds_name("external", self.directory / pr), persist)
+            self._external_sources[ds_name] = pr
+            self._use_generated((ds_name, ds_name, ds_name), persist)
             return ds
 
         else:
-            # but can also seperate
-            ds_pr = xr.open_dataset(self.directory / self.pr)
-            ds_evspsblpot = xr.open_dataset(self.directory / self.evspsblpot)
-            ds_tas = xr.open_dataset(self.directory / self.tas)
-            combined_data_vars = list(ds_pr.data_vars) + list(ds_evspsblpot.data_vars) + list(ds_tas.data_vars)
+            # but can also seperate: two of the three can still share a file, open & crop each file once
+            datasets = {path: xr.open_dataset(self.directory / path) for path in {pr, evspsblpot, tas}}
+            combined_data_vars = [var for ds in datasets.values() for var in ds.data_vars]
             if sum([param in combined_data_vars for param in REQUIRED_PARAMS]) != len(REQUIRED_PARAMS):
                 raise UserWarning(f"Supplied NetCDF files must contain {REQUIRED_PARAMS} respectively")
 
-            ds_pr, ds_name_pr = self.crop_ds(ds_pr, "external")
-            self.pr = ds_name_pr
-
-            ds_evspsblpot, ds_name_evspsblpot = self.crop_ds(ds_evspsblpot, "external")
-            self.evspsblpot = ds_name_evspsblpot
-
-            ds_tas, ds_name_tas = self.crop_ds(ds_tas, "external")
-            self.tas = ds_name_tas
+            cropped = {path: self.crop_ds(ds, self.cached_ds_name("external", self.directory / path), persist)
+                       for path, ds in datasets.items()}
+            ds_pr, ds_name_pr = cropped[pr]
+            ds_evspsblpot, ds_name_evspsblpot = cropped[evspsblpot]
+            ds_tas, ds_name_tas = cropped[tas]
+            self._external_sources.update({ds_name_pr: pr, ds_name_evspsblpot: evspsblpot, ds_name_tas: tas})
+            self._use_generated((ds_name_pr, ds_name_evspsblpot, ds_name_tas), persist)
 
             return ds_pr, ds_evspsblpot, ds_tas
 
-    def crop_ds(self, ds: xr.Dataset, name: str):
+    def crop_time(self, ds: xr.Dataset) -> xr.Dataset:
+        """Select the period between start_time & end_time (inclusive) from the dataset"""
         start = pd.Timestamp(get_time(self.start_time)).tz_convert(None)
         end = pd.Timestamp(get_time(self.end_time)).tz_convert(None)
-        ds = ds.isel(time=(ds['time'].values >= start) & (ds['time'].values <= end))
+        if ds.indexes['time'].is_monotonic_increasing:
+            # binary search on the index, no boolean masks needed
+            return ds.sel(time=slice(start, end))
+        return ds.isel(time=(ds['time'].values >= start) & (ds['time'].values <= end))
+
+    def cached_ds_name(self, name: str, fn: Path, *args) -> str:
+        """Name for the generated forcing file based on a hash of the source file (path, mtime & size),
+         the period and any other arguments which change the content. Same inputs give the same name."""
+        stat = fn.stat()
+        # the path too: same sized files unpacked from one archive share their mtime
+        key_parts = [fn.resolve(), stat.st_mtime_ns, stat.st_size, self.start_time, self.end_time, *args]
+        key = hashlib.blake2b("|".join(str(part) for part in key_parts).encode(), digest_size=8).hexdigest()
+        return f"HBV_forcing_{name}_{key}.nc"
+
+    def _load_cached(self, ds_name: str, persist: bool = True) -> xr.Dataset:
+        """Load a previously generated forcing file, pointing pr/evspsblpot/tas at it when persisting.
+        Loaded & closed: the same as a freshly generated dataset, no file handle left open"""
+        self._use_generated((ds_name, ds_name, ds_name), persist)
+        with xr.open_dataset(self.directory / ds_name) as ds:
+            return ds.load()
+
+    def _use_generated(self, ds_names: tuple[str, str, str], persist: bool = True) -> None:
+        """Point pr, evspsblpot & tas at the generated forcing files, only when persisting (nothing was written otherwise)"""
+        if persist:
+            self.pr, self.evspsblpot, self.tas = ds_names
+
+    def crop_ds(self, ds: xr.Dataset, ds_name: str, persist: bool = True, float32: bool = False):
+        """Crop the dataset to the forcing period & write it to ds_name (see cached_ds_name) in the forcing directory,
+        when that file already exists or persist is False the write is skipped.
+        float32 stores the float variables in single precision: for forcing generated here, external data keeps its dtype"""
+        ds = self.crop_time(ds)
 
-        time = str(datetime.now())[:-10].replace(":", "_")
-        letters = string.ascii_lowercase + string.ascii_uppercase
-        unique_identifier = ''.join((secrets.choice(letters)) for _ in range(5))
-        ds_name = f"HBV_forcing_{name}_{time}_{unique_identifier}.nc"
         out_dir = self.directory / ds_name
-        if not out_dir.exists():
-            ds.to_netcdf(out_dir)
+        if persist and not out_dir.exists():
+            # write to a temporary file first: forcing generated at the same time can share a name
+            tmp_file = out_dir.with_suffix(f".{os.getpid()}.tmp")
+            # large chunks along time (series are always read whole) & light compression,
+            # on top of the packing of the source (e.g. int16 with scale_factor) which an explicit encoding replaces
+            encoding = {var: {key: value for key, value in ds[var].encoding.items()
+                              if key in ("dtype", "scale_factor", "add_offset", "_FillValue")}
+                        for var in ds.data_vars if ds[var].dtype.kind == "f"}
+            for var in encoding:
+                encoding[var].update({"zlib": True, "complevel": 1})
+                if float32:
+                    encoding[var]["dtype"] = "float32"
+            chunksize = min(ds.sizes["time"], TIME_CHUNK_SIZE)
+            for var in encoding:
+                if ds[var].dims == ("time",) and chunksize > 0:
+                    encoding[var]["chunksizes"] = (chunksize,)
+            ds.to_netcdf(tmp_file, encoding=encoding)
+            os.replace(tmp_file, out_dir)
 
         return ds, ds_name
 
@@ -313,7 +387,12 @@ def calc_pet(s_rad, t_min, t_max, doy, alpha, elev, lat) -> np.ndarray:
 
     Returns:
         pet: np.ndarray
-            Array containing PET estimates in mm/day
+            Array containing PET estimates in mm/day, in the float precision of the input (float32 stays float32)
+
+    Note:
+        The series is evaluated in blocks of :py:const:`PET_BLOCK_SIZE` time steps,
+        this keeps the intermediate arrays of the calculation in cache instead of streaming
+        every one of them through memory for the whole record.
 
     Reference:
         based on code from:
@@ -326,6 +405,20 @@ def calc_pet(s_rad, t_min, t_max, doy, alpha, elev, lat) -> np.ndarray:
         `Newman et al (2015) <https://hess.copernicus.org/articles/21/5293/2017/>`_
 
     """
+    s_rad, t_min, t_max, doy = np.broadcast_arrays(s_rad, t_min, t_max, doy)
+    # float32 input stays float32: cast the scalars & day of year so they don't promote the calculation
+    dtype = np.result_type(s_rad, t_min, t_max, np.float32)
+    doy = doy.astype(dtype)
+    alpha, elev, lat = (np.asarray(value, dtype=dtype) for value in (alpha, elev, lat))
+    pet = np.empty(s_rad.shape, dtype=dtype)
+    for start in range(0, s_rad.shape[0], PET_BLOCK_SIZE):
+        block = slice(start, start + PET_BLOCK_SIZE)
+        pet[block] = _calc_pet_block(s_rad[block], t_min[block], t_max[block], doy[block], alpha, elev, lat)
+    return pet
+
+
+def _calc_pet_block(s_rad, t_min, t_max, doy, alpha, elev, lat) -> np.ndarray:
+    """Priestly–Taylor PET estimate for one block of time steps, see :py:func:`calc_pet`"""
     G = 0
     LAMBDA = 2.45  # MJ/kg
 
@@ -333,28 +426,31 @@ def calc_pet(s_rad, t_min, t_max, doy, alpha, elev, lat) -> np.ndarray:
     albedo = 0.23  # planetary albedo
     in_sw_rad = (1 - albedo) * s_rad
 
+    # day of year as angle, used for both the solar declination & the earth-sun distance
+    omega = (2 * np.pi / 365) * doy
+
     # solar declination
-    sol_dec = 0.409 * np.sin((2 * np.pi) / 365 * doy - 1.39)  # Equation 24 FAO-56 Allen et al. (1998)
+    sol_dec = 0.409 * np.sin(omega - 1.39)  # Equation 24 FAO-56 Allen et al. (1998)
 
     # Sunset hour angle
     lat = lat * (np.pi / 180)  # degree to rad
-    term = -np.tan(lat) * np.tan(sol_dec)
-    term[term < -1] = -1
-    term[term > 1] = 1
+    sin_lat, cos_lat, tan_lat = np.sin(lat), np.cos(lat), np.tan(lat)  # scalars, computed once
+    term = -tan_lat * np.tan(sol_dec)
+    np.clip(term, -1, 1, out=term)
     sha = np.arccos(term)
 
     # Inverse relative distance between Earth and Sun:
-    ird = 1 + 0.033 * np.cos((2 * np.pi) / 365 * doy)  # Equation 23 FAO-56 Allen et al. (1998)
+    ird = 1 + 0.033 * np.cos(omega)  # Equation 23 FAO-56 Allen et al. (1998)
 
     # Extraterrestrial Radiation -  Equation 21 FAO-56 Allen et al. (1998)
     et_rad = ((24 * 60) / np.pi * 0.082 * ird) * (
-                sha * np.sin(lat) * np.sin(sol_dec) + np.cos(lat) * np.cos(sol_dec) * np.sin(sha))
+                sha * sin_lat * np.sin(sol_dec) + cos_lat * np.cos(sol_dec) * np.sin(sha))
 
     # Clear sky radiation Equation 37 FAO-56 Allen et al. (1998)
     cs_rad = (0.75 + 2 * 10e-5 * elev) * et_rad
 
     # Actual vapor pressure estimated using min temperature - Equation 48 FAO-56 Allen et al. (1998
-    avp = 0.611 * np.exp((17.27 * t_min) / (t_min + 237.3))
+    avp = 0.611 * _svp_exp(t_min)[0]
 
     # Net outgoing long wave radiation - Equation 49 FAO-56 Allen et al. (1998)
     term1 = ((t_max + 273.16) ** 4 + (t_min + 273.16) ** 4) / 2  # conversion in K in equation
@@ -364,14 +460,23 @@ def calc_pet(s_rad, t_min, t_max, doy, alpha, elev, lat) -> np.ndarray:
     out_lw_rad = stefan_boltzman * term1 * term2 * term3
 
     # psychrometer constant (kPa/C) - varies with altitude
+    # scalar: atmospheric pressure = 101.3 * temp ** 5.26 (Equation 7 FAO-56 Allen et al. (1998)) & gamma = 0.000665 * pressure
     temp = (293.0 - 0.0065 * elev) / 293.0
-    atm_pressure = np.power(temp, 5.26) * 101.3  # Equation 7 FAO-56 Allen et al. (1998)
-    gamma = 0.000665 * atm_pressure
+    gamma = 0.0673645 * temp ** 5.26
 
     # Slope of saturation vapour pressure curve Equation 13 FAO-56 Allen et al. (1998)
     t_mean = 0.5 * (t_min + t_max)
-    s = 4098 * (0.6108 * np.exp((17.27 * t_mean) / (t_mean + 237.3))) / ((t_mean + 237.3) ** 2)
+    svp_exp, denom = _svp_exp(t_mean)
+    s = 4098 * (0.6108 * svp_exp) / (denom * denom)
 
     rn = in_sw_rad - out_lw_rad
-    pet = ((alpha / LAMBDA) * s * (rn - G)) / (s + gamma)
-    return pet * 0.408  # energy to evap
\ No newline at end of file
+    # scalar factors folded into one coefficient: 0.408 converts energy to evap
+    coef = alpha / LAMBDA * 0.408
+    return (coef * s * (rn - G)) / (s + gamma)
+
+
+def _svp_exp(t):
+    """Exponential term of the saturation vapour pressure, exp(17.27 T / (T + 237.3)) (Equation 11 FAO-56 Allen et al. (1998)),
+    also returns T + 237.3 so the slope (Equation 13) can reuse it"""
+    denom = t + 237.3
+    return np.exp((17.27 * t) / denom), denom
\ No newline at end of file
@@ -1,14 +1,20 @@
 """eWaterCycle wrapper for the HBV model."""
 import json
+import numpy as np
 import xarray as xr
 import warnings
 import os
 from collections.abc import ItemsView
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Type
+from typing import Any, Optional, Type
 
 from ewatercycle.forcing import LumpedMakkinkForcing
 from ewatercycle.forcing import GenericLumpedForcing
+try:
+    from ewatercycle.forcing import CaravanForcing
+except ImportError:  # ewatercycle versions without Caravan support
+    CaravanForcing = None
 
 from ewatercycle_HBV.forcing import HBVForcing # Use custom forcing instead
 from ewatercycle.base.model import (
@@ -30,6 +36,56 @@ def import_bmi():
 
     return HBV_bmi
 
+def is_up_to_date(target: Path, source: Path) -> bool:
+    """Check whether target exists & was written after source last changed, i.e. a conversion can be reused"""
+    try:
+        return target.stat().st_mtime_ns >= source.stat().st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+def converted_encoding(da: xr.DataArray) -> dict:
+    """NetCDF encoding for unit converted forcing: an intermediate file read whole by the model,
+    so one uncompressed chunk of float32 (ample for forcing data)"""
+    return {"zlib": False, "shuffle": False, "chunksizes": da.shape, "dtype": "float32"}
+
+@lru_cache(maxsize=256)
+def parse_config_values(values: str, names: tuple[str, ...]) -> dict[str, Any]:
+    """Map the comma separated parameters/initial_storage config string to names,
+    cached: ensemble members & repeated property access share the result (don't modify it)"""
+    return dict(zip(names, values.split(',')))
+
+def convert_makkink_file(source: Path, target: Path, var: str) -> Path:
+    """Convert var in a LumpedMakkinkForcing file to the units HBV uses: mm for pr & evspsblpot, degC for tas.
+
+    Returns the file to give to the model: target, or source when it is in those units already.
+    A target written after the source was last changed is reused as is.
+    """
+    if is_up_to_date(target, source):
+        return target
+
+    # the context manager closes the source even if the conversion fails
+    with xr.open_dataset(source) as ds:
+        da = ds[var]
+        # only the header is read to check the units
+        units = da.attrs.get('units')
+        if var == 'tas':
+            if units in DEGC_UNITS:
+                return source
+            values = da.load().values
+            # trust the units attribute, only fall back on the mean when it is missing/unknown
+            if units in KELVIN_UNITS or np.nanmean(values) > 200: # adjust for kelvin units
+                np.subtract(values, 273.15, out=values)
+                da.attrs.update({'units': 'degC'})
+        else:
+            if units in MM_UNITS:
+                return source
+            # convert the loaded values in place, no converted copy needed
+            values = da.load().values
+            np.multiply(values, 86400, out=values)
+            da.attrs.update({'units': 'mm'})
+        ds.to_netcdf(target, encoding={var: converted_encoding(da)})
+    return target
+
 HBV_PARAMS = (
     "Imax",
     "Ce",
@@ -50,6 +106,26 @@ HBV_STATES = (
     "Sp",
 )
 
+FORCING_CONFIG_KEYS = (
+    "precipitation_file",
+    "potential_evaporation_file",
+    "mean_temperature_file",
+)
+
+# units for which the LumpedMakkinkForcing files can be passed to the model without conversion
+MM_UNITS = ("mm", "mm/d", "mm/day", "mm d-1")
+DEGC_UNITS = ("degC", "°C", "C", "celsius", "degree_Celsius")
+KELVIN_UNITS = ("K", "kelvin", "Kelvin")
+
+# HBVMethods method preparing the forcing files, per forcing class
+FORCING_HANDLERS = {
+    HBVForcing: "_set_hbv_forcing_files",
+    LumpedMakkinkForcing: "_set_makkink_forcing_files",
+    GenericLumpedForcing: "_reject_generic_lumped_forcing",
+}
+if CaravanForcing is not None:
+    FORCING_HANDLERS[CaravanForcing] = "_set_caravan_forcing_files"
+
 class HBVMethods(eWaterCycleModel):
     """
     The eWatercycle HBV model.
@@ -65,97 +141,87 @@ class HBVMethods(eWaterCycleModel):
         "parameters": "",
         "initial_storage": "",
                         }
+    # the forcing (dumped after processing) the forcing files in _config belong to
+    _prepared_forcing: dict[str, Any] | None = None
+
+    def _set_forcing_files(self) -> None:
+        """Prepare the forcing files & point the configuration at them, using the handler for the forcing type."""
+        # walk the MRO: the most specific forcing class with a handler wins, so subclasses work too
+        for forcing_class in type(self.forcing).__mro__:
+            if forcing_class in FORCING_HANDLERS:
+                getattr(self, FORCING_HANDLERS[forcing_class])()
+                return
+
+    def _set_hbv_forcing_files(self) -> None:
+        """Generate the forcing NetCDF from the HBVForcing sources (txt or NetCDF)."""
+        forcing = self.forcing
+        if forcing.test_data_bool:
+            forcing.from_test_txt()
+        elif forcing.camels_txt_defined():
+            forcing.from_camels_txt()
+        elif forcing.forcing_nc_defined():
+            forcing.from_external_source()
+        else:
+            raise UserWarning("Ensure either a txt file with camels data or an(/set of) xarrays is defined")
+
+        # the from_* methods above point pr, evspsblpot & tas at the generated files
+        directory = forcing.directory
+        self._config["precipitation_file"] = str(directory / forcing.pr)
+        self._config["potential_evaporation_file"] = str(directory / forcing.evspsblpot)
+        self._config["mean_temperature_file"] = str(directory / forcing.tas)
+
+    def _set_caravan_forcing_files(self) -> None:
+        """Point the configuration at the CaravanForcing files directly."""
+        self._config["precipitation_file"] = str(
+            self.forcing.directory / self.forcing['pr']
+        )
+
+        self._config["potential_evaporation_file"] = str(
+            self.forcing.directory / self.forcing['evspsblpot']
+        )
+
+        self._config["mean_temperature_file"] = str(
+            self.forcing.directory / self.forcing['tas']
+        )
+
+    def _set_makkink_forcing_files(self) -> None:
+        """Convert LumpedMakkinkForcing files to mm & degC where needed."""
+        directory = self.forcing.directory
+        filenames = self.forcing.filenames
+        self._config["precipitation_file"] = str(convert_makkink_file(
+            directory / filenames['pr'], directory / filenames['pr'].replace('pr', 'pr_mm'), 'pr'))
+        self._config["potential_evaporation_file"] = str(convert_makkink_file(
+            directory / filenames['evspsblpot'],
+            directory / filenames['evspsblpot'].replace('evspsblpot', 'evspsblpot_mm'),
+            'evspsblpot'))
+        self._config["mean_temperature_file"] = str(convert_makkink_file(
+            directory / filenames['tas'], directory / filenames['tas'].replace('tas', 'tas_deg'), 'tas'))
+
+    def _reject_generic_lumped_forcing(self) -> None:
+        """GenericLumpedForcing can't be used: it has no potential evaporation."""
+        msg = "Generic Lumped Forcing does not provide potential evaporation, which this model needs"
+        raise UserWarning(msg)
 
     def _make_cfg_file(self, **kwargs) -> Path:
         """Write model configuration file."""
 
-        # do some basic test to check on forcing
-        if type(self.forcing).__name__ == 'HBVForcing':
-            if self.forcing.test_data_bool:
-                self.forcing.from_test_txt()
-            elif self.forcing.camels_txt_defined():
-                self.forcing.from_camels_txt()
-            elif self.forcing.forcing_nc_defined():
-                self.forcing.from_external_source()
-            else:
-                raise UserWarning("Ensure either a txt file with camels data or an(/set of) xarrays is defined")
-
-            self._config["precipitation_file"] = str(
-                self.forcing.directory / self.forcing.pr
-            )
-
-            self._config["potential_evaporation_file"] = str(
-                self.forcing.directory / self.forcing.evspsblpot
-            )
-            self._config["mean_temperature_file"] = str(
-                self.forcing.directory / self.forcing.tas)
-
-        elif type(self.forcing).__name__ == 'CaravanForcing':
-            self._config["precipitation_file"] = str(
-                self.forcing.directory / self.forcing['pr']
-            )
-
-            self._config["potential_evaporation_file"] = str(
-                self.forcing.directory / self.forcing['evspsblpot']
-            )
-
-            self._config["mean_temperature_file"] = str(
-                self.forcing.directory / self.forcing['tas']
-            )
-
-        elif type(self.forcing).__name__ == 'GenericLumpedForcing':
-                msg = "Generic Lumped Forcing does not provide potential evaporation, which this model needs"
-                raise UserWarning(msg)
-
-        elif type(self.forcing).__name__ == 'LumpedMakkinkForcing':
-            temporary_evspsblpot_file = (self.forcing.directory /
-                                         self.forcing.filenames['evspsblpot'].replace('evspsblpot',
-                                                                                  'evspsblpot_mm'))
-            if not temporary_evspsblpot_file.is_file():
-                ds = xr.open_dataset(self.forcing.directory /
-                                     self.forcing.filenames['evspsblpot'])
-                ds['evspsblpot'].attrs.update({'units':'mm'})
-                ds['evspsblpot'] = ds['evspsblpot'] * 86400
-                ds.to_netcdf(temporary_evspsblpot_file)
-                ds.close()
-
-            temporary_pr_file = (self.forcing.directory /
-                                 self.forcing.filenames['pr'].replace('pr', 'pr_mm'))
-            if not temporary_pr_file.is_file():
-                ds = xr.open_dataset(self.forcing.directory / self.forcing.filenames['pr'])
-                ds['pr'].attrs.update({'units':'mm'})
-                ds['pr'] = ds['pr'] * 86400
-                ds.to_netcdf(temporary_pr_file)
-                ds.close()
-
-            temporary_tas_file = (self.forcing.directory /
-                                  self.forcing.filenames['tas'].replace('tas', 'tas_deg'))
-            if not temporary_tas_file.is_file():
-                ds = xr.open_dataset(self.forcing.directory / self.forcing.filenames['tas'])
-                if ds['tas'].mean().values > 200: # adjust for kelvin units
-                    ds['tas'] -= 273.15
-                    ds['tas'].attrs.update({'units':'degC'})
-                ds.to_netcdf(temporary_tas_file)
-                ds.close()
-
-            self._config["precipitation_file"] = str(
-                temporary_pr_file
-            )
-            self._config["potential_evaporation_file"] = str(
-                temporary_evspsblpot_file
-            )
-
-            self._config["mean_temperature_file"] = str(
-                temporary_tas_file
-            )
-
-        for kwarg in kwargs:  # Write any kwargs to the config. - doesn't overwrite config?
-            self._config[kwarg] = kwargs[kwarg]
+        # processing the forcing opens & possibly converts files: only redo it when the forcing changed
+        if (self._prepared_forcing != self.forcing.model_dump()
+                or not all(os.path.isfile(self._config[key]) for key in FORCING_CONFIG_KEYS)):
+            self._set_forcing_files()
+            self._prepared_forcing = self.forcing.model_dump()
+
+        self._config.update(kwargs)  # Write any kwargs to the config.
 
         config_file = self._cfg_dir / "HBV_config.json"
+        config_text = json.dumps(self._config, indent=4)
 
-        with config_file.open(mode="w") as f:
-            f.write(json.dumps(self._config, indent=4))
+        # setting up again in the same cfg_dir with the same config (e.g. DA ensembles) leaves the file as is
+        if not (config_file.is_file() and config_file.read_text() == config_text):
+            # write next to it & rename: a reader never sees a half written config
+            tmp_file = config_file.with_suffix(f".{os.getpid()}.tmp")
+            tmp_file.write_text(config_text)
+            os.replace(tmp_file, config_file)
 
         return config_file
 
@@ -191,8 +257,7 @@ class HBVMethods(eWaterCycleModel):
             FM (mm/deg/d): Melt Factor: mm of melt per deg per day
 
         """
-        pars: dict[str, Any] = dict(zip(HBV_PARAMS, self._config["parameters"].split(',')))
-        return pars.items()
+        return parse_config_values(self._config["parameters"], HBV_PARAMS).items()
 
     @property
     def states(self) -> ItemsView[str, Any]:
@@ -206,8 +271,7 @@ class HBVMethods(eWaterCycleModel):
             Sp (mm): SnowPack Storage, amount of snow stored
 
         """
-        pars: dict[str, Any] = dict(zip(HBV_STATES, self._config["initial_storage"].split(',')))
-        return pars.items()
+        return parse_config_values(self._config["initial_storage"], HBV_STATES).items()
 
 
     def finalize(self) -> None:
@@ -228,4 +292,11 @@ class HBV(ContainerizedModel, HBVMethods):
 
 class HBVLocal(LocalModel, HBVMethods):
     """The HBV eWaterCycle model, with the local BMI."""
-    bmi_class: Type[Bmi] = import_bmi()
+    # imported on first setup: importing this module shouldn't require (or load) the HBV package
+    bmi_class: Optional[Type[Bmi]] = None
+
+    def _make_bmi_instance(self) -> Bmi:
+        if self.bmi_class is None:
+            self.bmi_class = import_bmi()
+        # LocalModel wraps the instance, eWaterCycleModel.get_value relies on the optional dest
+        return super()._make_bmi_instance()
@@ -1,7 +1,154 @@
+import os
+import shutil
+from pathlib import Path
+
 import numpy as np
-from ewatercycle_HBV.forcing import calc_pet
+import pandas as pd
+import xarray as xr
+from ewatercycle_HBV.forcing import HBVForcing, calc_pet
 
 
 def test_calc_pet():
     """tests s_rad, t_min, t_max, doy, alpha, elev, lat"""
-    assert calc_pet(np.array([0]), np.array([0]), np.array([0]), np.array([0]), np.array([0]), np.array([0]), np.array([0])) == np.array([0])
\ No newline at end of file
+    assert calc_pet(np.array([0]), np.array([0]), np.array([0]), np.array([0]), np.array([0]), np.array([0]), np.array([0])) == np.array([0])
+
+
+def test_calc_pet_time_series():
+    """longer than PET_BLOCK_SIZE: the blocked evaluation should match evaluating each day on its own"""
+    n = 10000
+    rng = np.random.default_rng(42)
+    s_rad = rng.uniform(0, 300, n)
+    t_min = rng.uniform(-10, 10, n)
+    t_max = t_min + rng.uniform(0, 15, n)
+    doy = np.arange(n) % 365 + 1
+    pet = calc_pet(s_rad, t_min, t_max, doy, 1.26, 300.0, 52.0)
+    assert pet.shape == (n,)
+    expected = np.concatenate([calc_pet(s_rad[i:i + 1], t_min[i:i + 1], t_max[i:i + 1], doy[i:i + 1], 1.26, 300.0, 52.0)
+                               for i in range(n)])
+    np.testing.assert_allclose(pet, expected)
+
+
+def test_calc_pet_keeps_float32():
+    """float32 forcing should not be promoted to float64 by the scalar inputs"""
+    pet = calc_pet(np.full(10, 200, dtype=np.float32), np.zeros(10, dtype=np.float32),
+                   np.full(10, 10, dtype=np.float32), np.arange(1, 11), 1.26, 300.0, 52.0)
+    assert pet.dtype == np.float32
+
+
+
+def test_external_source_same_size_and_mtime(tmp_path):
+    """separate files of the same size & mtime (e.g. unpacked from one archive) must not share a generated file"""
+    time = pd.date_range("1997-08-01", "1997-12-31")
+    for var in ["pr", "evspsblpot", "tas"]:
+        xr.Dataset({var: ("time", np.arange(len(time), dtype="float64"))}, coords={"time": time}).to_netcdf(
+            tmp_path / f"{var}.nc")
+        os.utime(tmp_path / f"{var}.nc", ns=(1_000_000_000, 1_000_000_000))
+    assert len({(tmp_path / f"{var}.nc").stat().st_size for var in ["pr", "evspsblpot", "tas"]}) == 1
+
+    forcing = HBVForcing(directory=tmp_path,
+                         start_time="1997-08-01T00:00:00Z",
+                         end_time="1997-10-31T00:00:00Z",
+                         pr="pr.nc",
+                         evspsblpot="evspsblpot.nc",
+                         tas="tas.nc")
+    forcing.from_external_source()
+    assert len({forcing.pr, forcing.evspsblpot, forcing.tas}) == 3
+    for var in ["pr", "evspsblpot", "tas"]:
+        with xr.open_dataset(tmp_path / getattr(forcing, var)) as ds:
+            assert var in ds.data_vars
+
+
+def test_external_source_repeated(tmp_path):
+    """calling again (e.g. setting up another model with the same forcing) reuses the generated file"""
+    time = pd.date_range("1997-08-01", "1997-12-31")
+    xr.Dataset({var: ("time", np.linspace(0, 1, len(time))) for var in ["pr", "evspsblpot", "tas"]},
+               coords={"time": time}).to_netcdf(tmp_path / "forcing.nc")
+    forcing = HBVForcing(directory=tmp_path,
+                         start_time="1997-08-01T00:00:00Z",
+                         end_time="1997-10-31T00:00:00Z",
+                         pr="forcing.nc",
+                         evspsblpot="forcing.nc",
+                         tas="forcing.nc")
+    forcing.from_external_source()
+    generated = forcing.pr
+    forcing.from_external_source()
+    assert forcing.pr == generated
+    assert len(list(tmp_path.glob("HBV_forcing_external_*.nc"))) == 1
+
+    # a longer period is cropped from the source, not from the shorter generated file
+    forcing.end_time = "1997-12-31T00:00:00Z"
+    forcing.from_external_source()
+    with xr.open_dataset(tmp_path / forcing.pr) as ds:
+        assert ds.sizes["time"] == len(time)
+
+
+def test_test_txt_cached(tmp_path):
+    """the second call reuses the generated file & returns the same data, dtypes included"""
+    shutil.copy(Path(__file__).parent / "files" / "test_forcing.txt", tmp_path / "test_forcing.txt")
+    forcing = HBVForcing(directory=tmp_path,
+                         start_time="1997-08-01T00:00:00Z",
+                         end_time="1997-12-31T00:00:00Z",
+                         camels_file="test_forcing.txt",
+                         test_data_bool=True)
+    generated = forcing.from_test_txt()
+    cached = forcing.from_test_txt()
+    assert len(list(tmp_path.glob("HBV_forcing_test_*.nc"))) == 1
+    # closed after loading: the file can be removed while the data is still usable
+    (tmp_path / forcing.pr).unlink()
+    xr.testing.assert_identical(generated, cached)
+    assert all(generated[var].dtype == cached[var].dtype for var in generated.data_vars)
+
+
+def test_test_txt_not_persisted(tmp_path):
+    """persist=False neither writes a file nor points the forcing at one, also when a generated file exists"""
+    shutil.copy(Path(__file__).parent / "files" / "test_forcing.txt", tmp_path / "test_forcing.txt")
+    forcing = HBVForcing(directory=tmp_path,
+                         start_time="1997-08-01T00:00:00Z",
+                         end_time="1997-12-31T00:00:00Z",
+                         camels_file="test_forcing.txt",
+                         test_data_bool=True)
+    ds = forcing.from_test_txt(persist=False)
+    assert ds.sizes["time"] == 153
+    assert not list(tmp_path.glob("HBV_forcing_*.nc"))
+    assert forcing.pr == forcing.evspsblpot == forcing.tas == ".nc"
+
+    # cache hit
+    HBVForcing(**forcing.model_dump()).from_test_txt()
+    forcing.from_test_txt(persist=False)
+    assert forcing.pr == forcing.evspsblpot == forcing.tas == ".nc"
+
+
+def test_external_source_keeps_dtype(tmp_path):
+    """user supplied float64 forcing isn't downcast when it is cropped & written"""
+    time = pd.date_range("1997-08-01", "1997-12-31")
+    xr.Dataset({var: ("time", np.linspace(0, 1, len(time))) for var in ["pr", "evspsblpot", "tas"]},
+               coords={"time": time}).to_netcdf(tmp_path / "forcing.nc")
+    forcing = HBVForcing(directory=tmp_path,
+                         start_time="1997-08-01T00:00:00Z",
+                         end_time="1997-10-31T00:00:00Z",
+                         pr="forcing.nc",
+                         evspsblpot="forcing.nc",
+                         tas="forcing.nc")
+    forcing.from_external_source()
+    with xr.open_dataset(tmp_path / forcing.pr) as ds:
+        assert ds["pr"].dtype == np.float64
+
+
+def test_external_source_keeps_packing(tmp_path):
+    """packed forcing (int16 with scale_factor/add_offset) is written packed again"""
+    time = pd.date_range("1997-08-01", "1997-12-31")
+    encoding = {"dtype": "int16", "scale_factor": 0.01, "add_offset": 10.0, "_FillValue": -32767}
+    xr.Dataset({var: ("time", np.linspace(0, 1, len(time))) for var in ["pr", "evspsblpot", "tas"]},
+               coords={"time": time}).to_netcdf(tmp_path / "forcing.nc",
+                                                encoding={var: encoding for var in ["pr", "evspsblpot", "tas"]})
+    forcing = HBVForcing(directory=tmp_path,
+                         start_time="1997-08-01T00:00:00Z",
+                         end_time="1997-10-31T00:00:00Z",
+                         pr="forcing.nc",
+                         evspsblpot="forcing.nc",
+                         tas="forcing.nc")
+    forcing.from_external_source()
+    with xr.open_dataset(tmp_path / forcing.pr, mask_and_scale=False) as ds:
+        assert ds["pr"].dtype == np.int16
+        assert ds["pr"].attrs["scale_factor"] == 0.01
+        assert ds["pr"].attrs["add_offset"] == 10.0
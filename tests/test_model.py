@@ -1 +1,105 @@
-# https://github.com/eWaterCycle/ewatercycle-hype/blob/main/tests/test_forcing.py
\ No newline at end of file
+# https://github.com/eWaterCycle/ewatercycle-hype/blob/main/tests/test_forcing.py
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from ewatercycle_HBV.forcing import HBVForcing
+from ewatercycle_HBV.model import HBVLocal, convert_makkink_file
+
+
+def make_forcing(tmp_path, forcing_class=HBVForcing):
+    """HBVForcing using the test data, copied to tmp_path"""
+    shutil.copy(Path(__file__).parent / "files" / "test_forcing.txt", tmp_path / "test_forcing.txt")
+    return forcing_class(directory=tmp_path,
+                         start_time="1997-08-01T00:00:00Z",
+                         end_time="1997-12-31T00:00:00Z",
+                         camels_file="test_forcing.txt",
+                         test_data_bool=True)
+
+
+def write_forcing_file(path, var, values, units=None):
+    """write a single variable forcing file as found in a LumpedMakkinkForcing"""
+    time = pd.date_range("1997-08-01", periods=len(values))
+    da = xr.DataArray(np.asarray(values, dtype="float64"), coords={"time": time}, dims="time", name=var)
+    if units is not None:
+        da.attrs["units"] = units
+    da.to_dataset().to_netcdf(path)
+    return path
+
+
+def test_forcing_prepared_once(tmp_path, monkeypatch):
+    """the forcing files are only prepared again when the forcing changes or a prepared file is missing"""
+    calls = []
+    set_forcing_files = HBVLocal._set_forcing_files
+    monkeypatch.setattr(HBVLocal, "_set_forcing_files", lambda self: calls.append(1) or set_forcing_files(self))
+
+    model = HBVLocal(forcing=make_forcing(tmp_path))
+    model._cfg_dir = tmp_path
+    model._make_cfg_file()
+    config_file = model._make_cfg_file()
+    assert len(calls) == 1
+    assert config_file.is_file()
+
+    Path(model._config["precipitation_file"]).unlink()
+    model._make_cfg_file()
+    assert len(calls) == 2
+
+    model.forcing.end_time = "1997-10-31T00:00:00Z"
+    model._make_cfg_file()
+    assert len(calls) == 3
+
+
+def test_subclassed_forcing(tmp_path):
+    """a subclass of HBVForcing is handled as an HBVForcing"""
+    class SubForcing(HBVForcing):
+        pass
+
+    model = HBVLocal(forcing=make_forcing(tmp_path, SubForcing))
+    model._cfg_dir = tmp_path
+    model._make_cfg_file()
+    assert model._config["precipitation_file"] == str(tmp_path / model.forcing.pr)
+    assert Path(model._config["precipitation_file"]).is_file()
+
+
+def test_local_get_value(tmp_path):
+    """values can be requested without passing dest, as for the other eWaterCycle models"""
+    pytest.importorskip("HBV")
+    model = HBVLocal(forcing=make_forcing(tmp_path))
+    config_file, _ = model.setup(cfg_dir=tmp_path / "cfg",
+                                 parameters="8,0.4,300,3,1,3,0.05,0.002,3",
+                                 initial_storage="0,100,0,5,0")
+    model.initialize(config_file)
+    model.update()
+    assert model.get_value("Q").shape == (1,)
+    model.finalize()
+
+
+def test_convert_makkink_kelvin(tmp_path):
+    """temperature in Kelvin is converted to degC, using the units or (when missing) the mean"""
+    for units in ["K", None]:
+        source = write_forcing_file(tmp_path / "tas.nc", "tas", [273.15, 283.15], units)
+        target = convert_makkink_file(source, tmp_path / f"tas_deg_{units}.nc", "tas")
+        assert target == tmp_path / f"tas_deg_{units}.nc"
+        with xr.open_dataset(target) as ds:
+            np.testing.assert_allclose(ds["tas"].values, [0, 10], atol=1e-4)
+            assert ds["tas"].attrs["units"] == "degC"
+
+
+def test_convert_makkink_precipitation(tmp_path):
+    """fluxes in kg m-2 s-1 are converted to mm (per day)"""
+    source = write_forcing_file(tmp_path / "pr.nc", "pr", [1 / 86400, 2 / 86400], "kg m-2 s-1")
+    target = convert_makkink_file(source, tmp_path / "pr_mm.nc", "pr")
+    with xr.open_dataset(target) as ds:
+        np.testing.assert_allclose(ds["pr"].values, [1, 2], rtol=1e-6)
+        assert ds["pr"].attrs["units"] == "mm"
+
+
+def test_convert_makkink_units_already_fit(tmp_path):
+    """files in mm or degC are used as is, no converted copy is written"""
+    for var, units in [("pr", "mm"), ("evspsblpot", "mm/day"), ("tas", "degC")]:
+        source = write_forcing_file(tmp_path / f"{var}.nc", var, [1.0, 2.0], units)
+        assert convert_makkink_file(source, tmp_path / f"{var}_converted.nc", var) == source
+        assert not (tmp_path / f"{var}_converted.nc").exists()